@@ -18,11 +18,83 @@
 ## along with this program; if not, see <http://www.gnu.org/licenses/>.
 ##
 
+import functools
 import sigrokdecode as srd
 
 class SamplerateError(Exception):
 	pass
 
+# VAN CRC-15: polynomial x^15 + x^11 + x^10 + x^9 + x^8 + x^7 + x^4 + x^3 +
+# x^2 + 1 (0xF9D) over the ID, COM and data fields, MSB first, with an
+# initial value and final XOR of 0x7FFF.
+CRC15_POLY = 0xF9D
+
+def crc15_table_entry(nibble):
+	crc = nibble << 11
+	for _ in range(4):
+		crc <<= 1
+		if crc & 0x8000:
+			crc ^= CRC15_POLY
+	return crc & 0x7FFF
+
+# Nibble-wise lookup table: every 4-bit group is fed into the running CRC
+# with a single lookup as soon as it is known not to be part of the CRC
+# field itself.
+CRC15_TABLE = tuple(crc15_table_entry(n) for n in range(16))
+
+# Prebuilt annotation data of a single-bit annotation, indexed by the bit
+# value. The labels are formatted with the bit value, the bare value is
+# always appended as the shortest label. libsigrokdecode copies the data
+# in put(), so the same lists can be passed for every bit.
+def bit_anns(ann, *labels):
+	return tuple([ann, [l.format(v) for l in labels] + [str(v)]] for v in (0, 1))
+
+DATA_BIT_ANN = bit_anns(11)
+STUFF_BIT_ANN = bit_anns(12, 'Stuff: {}', 'S({})')
+EOD_BIT_ANN = bit_anns(19, 'EOD bit: {}', 'EOD:{}')
+ACK_DELIMITER_BIT_ANN = bit_anns(20, 'ACK delimiter', 'Delimiter')
+ACK_SLOT_BIT_ANN = bit_anns(21, 'ACK slot:{}', 'ACK:{}')
+EOF_BIT_ANN = bit_anns(22)
+
+# Annotation data of each raw bit of the frame header (SOF, ID, COM),
+# indexed by raw bit number. Every later non-stuff bit is a data bit.
+HEADER_BIT_ANNS = (bit_anns(13),) * 10 + (bit_anns(14),) * 15 + (
+	bit_anns(15, 'EXT: {}', 'EXT{}'),
+	bit_anns(16, 'RAK: {}', 'RAK{}'),
+	bit_anns(17, 'R/W: {}', 'RW{}'),
+	bit_anns(18, 'RTR: {}', 'RTR{}'),
+)
+
+# Annotation data without any variable part, shared by all frames.
+SOF_ANN = [0, ['Start of frame', 'SOF', 'S']]
+EOD_ANN = [8, ['EOD']]
+ACK_ANN = [9, ['ACK']]
+EOF_ANN = [10, ['EOF']]
+ACK_DELIMITER_WARN_ANN = [23, ['ACK delimiter must be a recessive bit']]
+EOF_WARN_ANN = [23, ['End of frame (EOF) must be a recessive bit']]
+
+# Number of queued annotations after which they are flushed even in the
+# middle of a frame, so an unterminated frame (e.g. a glitch on an idle
+# bus) neither grows the queue without bound nor hides its annotations.
+MAX_PENDING = 1024
+
+# Annotation data of all 16 possible COM field values.
+COM_ANNS = tuple([5, [f'COM: {com}(0x{com:02X})', f'COM:0x{com:02X}', 'COM']] for com in range(16))
+
+# Annotation data of an identifier. There are only 4096 of them, so each
+# is formatted at most once and then reused for every frame carrying it.
+@functools.lru_cache(maxsize = None)
+def id_ann(id):
+	s = f'{id} (0x{id:X})'
+	return [1, [f'Identifier: {s}', f'ID: {s}', 'ID']]
+
+# Annotation data of a data byte, built once per (index, value) pair.
+# Devices on a VAN bus keep repeating the same frames, so most data
+# bytes are served from the cache instead of being formatted again.
+@functools.lru_cache(maxsize = 4096)
+def data_byte_ann(index, byte):
+	return [6, [f'Data[{index}]=0x{byte:02X}', f'D[{index}]=0x{byte:02x}', 'D']]
+
 class Decoder(srd.Decoder):
 	api_version = 3
 	id = 'van'
@@ -39,6 +111,8 @@ class Decoder(srd.Decoder):
 	options = (
 		{'id': 'nominal_bitrate', 'desc': 'Nominal bitrate (bits/s)', 'default': 125000},
 		{'id': 'sample_point', 'desc': 'Sample point (%)', 'default': 70.0},
+		{'id': 'show_bits', 'desc': 'Show individual bits', 'default': 'no',
+			'values': ('yes', 'no')},
 	)
 	annotations = (
 		('sof', 'Start of frame'), # 0
@@ -78,14 +152,25 @@ class Decoder(srd.Decoder):
 
 	def reset(self):
 		self.samplerate = None
+		self.pending = [] # Annotations not yet passed to put()
 		self.reset_variables()
 
 	def start(self):
 		self.out_ann = self.register(srd.OUTPUT_ANN)
+		# The per-bit annotations are by far the most numerous ones, so
+		# they are skipped entirely unless asked for.
+		self.show_bits = self.options['show_bits'] == 'yes'
 
 	def set_bit_rate(self, bitrate):
-		self.bit_width = float(self.samplerate) / float(bitrate)
-		self.sample_point = (self.bit_width / 100.0) * self.options['sample_point']
+		# Bit width and sample point offset in samples, as Q16 fixed point
+		# numbers. Sample points are computed with integer math only and
+		# don't accumulate float rounding errors over long captures.
+		self.bw_q16 = (int(self.samplerate) << 16) // int(bitrate)
+		self.sp_q16 = (self.bw_q16 * round(self.options['sample_point'] * 100)) // 10000
+		# Whole-sample versions of the above, used when placing annotations.
+		self.bw_int = self.bw_q16 >> 16
+		self.sp_left = self.sp_q16 >> 16
+		self.sp_right = (self.bw_q16 - self.sp_q16) >> 16
 
 	def set_nominal_bitrate(self):
 		self.set_bit_rate(self.options['nominal_bitrate'])
@@ -93,30 +178,50 @@ class Decoder(srd.Decoder):
 	def metadata(self, key, value):
 		if key == srd.SRD_CONF_SAMPLERATE:
 			self.samplerate = value
-			self.bit_width = float(self.samplerate) / float(self.options['nominal_bitrate'])
-			self.sample_point = (self.bit_width / 100.0) * self.options['sample_point']
+			self.set_nominal_bitrate()
 
-	# Generic helper for VAN bit annotations.
+	# Generic helper for VAN bit annotations. Annotations are queued and
+	# only passed to libsigrokdecode by flush(), once per EOD and EOF (or
+	# every MAX_PENDING annotations), instead of crossing into C for every
+	# single bit.
 	def putg(self, ss, es, data):
-		left, right = int(self.sample_point), int(self.bit_width - self.sample_point)
-		self.put(ss - left, es + right, self.out_ann, data)
+		pending = self.pending
+		pending.append((ss - self.sp_left, es + self.sp_right, data))
+		if len(pending) >= MAX_PENDING:
+			self.flush()
+
+	def flush(self):
+		put = self.put
+		out_ann = self.out_ann
+		for (ss, es, data) in self.pending:
+			put(ss, es, out_ann, data)
+		self.pending.clear()
 
-	# Single-VAN-bit annotation using the current samplenum.
+	# Single-VAN-bit annotation using the current samplenum. This runs for
+	# every bit, so it applies the cached offsets itself instead of going
+	# through putg().
 	def putx(self, data):
-		self.putg(self.samplenum, self.samplenum, data)
-	
+		samplenum = self.samplenum
+		pending = self.pending
+		pending.append((samplenum - self.sp_left, samplenum + self.sp_right, data))
+		if len(pending) >= MAX_PENDING:
+			self.flush()
+
 	# Multi-VAN-bit annotation from self.ss_block to current samplenum.
 	def putb(self, data):
-		self.putg(self.ss_block, self.samplenum, data)
+		pending = self.pending
+		pending.append((self.ss_block - self.sp_left, self.samplenum + self.sp_right, data))
+		if len(pending) >= MAX_PENDING:
+			self.flush()
 
 	def reset_variables(self):
-		self.state = 'IDLE'
-		self.rawbits = [] # All bits, including stuff bits
-		self.bits = [] # Only actual VAN frame bits (no stuff bits)
+		self.last2 = 0 # Last 2 raw bits, for the EOD check
+		self.bit_acc = 0 # Last 16 frame bits, most recent one in bit 0
+		self.next_stuff = 4 # Raw bit number of the next stuff bit
 		self.bit_groups = []
-		self.curbit = 0 # Current bit of VAN frame (bit 0 == SOF)
-		self.ss_block = None
-		self.data_blocks = []
+		self.curbit = 0 # Current raw bit of VAN frame (bit 0 == SOF), including stuff bits
+		self.ss_block = None # Start of the current group, None until its first bit
+		self.crc = 0x7FFF # Running CRC of the groups seen so far, minus the last four
 		self.done = False
 
 	# Poor man's clock synchronization. Use signal edges which change to
@@ -127,151 +232,207 @@ class Decoder(srd.Decoder):
 	def dom_edge_seen(self, force = False):
 		self.dom_edge_snum = self.samplenum
 		self.dom_edge_bcount = self.curbit
+		# Everything in the sample point position which only depends on
+		# the last edge (Q16), so that decode() is left with a single
+		# multiply-add per bit.
+		self.sample_base = (self.dom_edge_snum << 16) - self.bw_q16 * self.dom_edge_bcount + self.sp_q16
 
 	def bit_sampled(self):
 		# EMPTY
 		pass
 
-	# Determine the position of the next desired bit's sample point.
-	def get_sample_point(self, bitnum):
-		samplenum = self.dom_edge_snum
-		samplenum += self.bit_width * (bitnum - self.dom_edge_bcount)
-		samplenum += self.sample_point
-		return int(samplenum)
-		
+	# Field decoders, each run when group i (four frame bits plus their
+	# stuff bit) completes the field.
+	def decode_sof(self, i):
+		(begin, _, high) = self.bit_groups[0]
+		(_, end, low) = self.bit_groups[1]
+		byte = (high << 4) | low
+		self.putg(begin, end, SOF_ANN)
+		if byte != 0x0E:
+			self.putg(begin, end, [23, [f'Error! SOF = 0x{byte:X}, should be 0x0E']])
+
+	def decode_id(self, i):
+		# Groups 2..4, i.e. the last 12 frame bits.
+		id = self.bit_acc & 0xFFF
+		(begin, _, _) = self.bit_groups[2]
+		(_, end, _) = self.bit_groups[4]
+		self.putg(begin, end, id_ann(id))
+
+	def decode_com(self, i):
+		(begin, end, com) = self.bit_groups[5]
+		self.putg(begin, end, COM_ANNS[com])
+
+	# The last four groups of a frame hold the CRC, so a byte is only
+	# known to be data once four more groups have followed it.
+	def decode_data(self, i):
+		j = i - 4
+		(begin, _, high) = self.bit_groups[j - 1]
+		(_, end, low) = self.bit_groups[j]
+		byte = (high << 4) | low
+		index = (j - 7) // 2
+		self.putg(begin, end, data_byte_ann(index, byte))
+
+	# The frame layout is fixed, so the field decoder to run for each of
+	# the first groups is looked up by group index. Past this table, every
+	# odd group completes a (pending) data byte.
+	group_fields = (None, decode_sof, None, None, decode_id, decode_com,
+		None, None, None, None, None)
+
+	def decode_group(self, i):
+		# The last four groups may still turn out to be the CRC field, so
+		# the CRC runs four groups behind the one just closed.
+		if i >= 6:
+			crc = self.crc
+			self.crc = ((crc << 4) & 0x7FFF) ^ CRC15_TABLE[(crc >> 11) ^ self.bit_groups[i - 4][2]]
+		if i < len(self.group_fields):
+			field = self.group_fields[i]
+			if field:
+				field(self, i)
+		elif i & 1:
+			self.decode_data(i)
+
+	# Finish the frame once the EOD has been seen: the last four groups
+	# hold the 15 CRC bits, followed by the EOD bit.
 	def decode_frame(self):
-		count = 0
-		begin = 0
-		end = 0
-		byte = 0
-		groups = len(self.bit_groups)
-		for i in range(groups):
-			(ss,es,bits) = self.bit_groups[i]
-			if count == 0:
-				begin = ss
-				byte =  int(''.join(str(d) for d in bits), 2)
-				count = 1
-			elif count == 1:
-				count = 0
-				byte <<= 4
-				byte +=  int(''.join(str(d) for d in bits), 2)
-				end = es
-			if i == 1:
-				self.putg(begin, end, [0, ['Start of frame', 'SOF', 'S']])	
-				if byte != 0x0E:            
-					s = "Error! SOF = 0x%X, should be 0x0E" % byte
-					self.putg(begin, end,[23, [s]])
-			elif i == 4:
-				id = int(''.join(str(d) for d in self.bits[8:20]), 2)
-				s = '%d (0x%X)' % (id, id)
-				(begin,_,_) = self.bit_groups[2]
-				(_,end,_) = self.bit_groups[4]
-				self.putg(begin, end, [1,  ['Identifier: %s' % s, 'ID: %s' % s, 'ID']])	
-			elif i == 5:
-				(ss,end,_) = self.bit_groups[5]
-				begin = ss
-				end = es
-				com = int(''.join(str(d) for d in bits), 2)
-				self.putg(begin,end,[5, ['COM: %d(0x%02X)' % (com,com), 'COM:0x%02X' % com, 'COM']])
-
-			elif i >= 7 and i < (groups - 4) and i %2 == 1:
-				index = int((i - 7 ) / 2)
-				self.putg(begin, end, [6, ['Data[%d]=0x%02X' % (index,byte), 'D[%d]=0x%02x' % (index,byte), 'D']])
-			
-			elif i == groups - 3:
-				(begin,_,_) = self.bit_groups[-4]
-				(_,end,_) = self.bit_groups[-1]
-				end -= 2*int(self.bit_width)
-				crc = int(''.join(str(d) for d in self.bits[-16:-1]), 2)
-				self.putg(begin, end, [7, ['CRC=0x%04X' % crc, 'C=0x%04x' % crc, 'C']])
-
-			elif i == groups - 1:
-				end = es
-				begin = end - int(self.bit_width)
-				self.putg(begin,end,[8, ['EOD']])
-				self.done = True
-
-		return True				
+		(_, es, _) = self.bit_groups[-1]
+		if len(self.bit_groups) >= 4:
+			(begin, _, _) = self.bit_groups[-4]
+			end = es - 2*self.bw_int
+			# The 15 frame bits before the EOD bit.
+			crc = (self.bit_acc >> 1) & 0x7FFF
+			self.putg(begin, end, [7, [f'CRC=0x{crc:04X}', f'C=0x{crc:04x}', 'C']])
+			expected = self.crc ^ 0x7FFF
+			if crc != expected:
+				self.putg(begin, end, [23, [f'CRC error: 0x{crc:04X}, expected 0x{expected:04X}']])
+		self.putg(es - self.bw_int, es, EOD_ANN)
+		self.done = True
+		self.flush()
+		# Raw bit number of the first bit after the EOD (ACK delimiter).
+		self.tail_start = len(self.bit_groups) * 5
+
+	# Handle a bit between SOF and EOD (inclusive), stuff bits included.
+	def handle_frame_bit(self, van_rx, bitnum):
+		last2 = ((self.last2 << 1) | van_rx) & 0x3
+		self.last2 = last2
+		# Every fifth raw bit is the stuff bit closing a group.
+		if bitnum == self.next_stuff:
+			self.next_stuff = bitnum + 5
+			self.bit_groups.append((self.ss_block, self.samplenum, self.bit_acc & 0xF))
+			self.ss_block = None
+			self.decode_group(len(self.bit_groups) - 1)
+			# EOD: the last frame bit and the following (stuff) bit are
+			# both dominant, which E-Manchester coding never produces.
+			if last2 == 0:
+				if self.show_bits:
+					self.putx(EOD_BIT_ANN[van_rx])
+				self.decode_frame()
+			elif self.show_bits:
+				self.putx(STUFF_BIT_ANN[van_rx])
+		else:
+			if self.show_bits:
+				if bitnum < len(HEADER_BIT_ANNS):
+					self.putx(HEADER_BIT_ANNS[bitnum][van_rx])
+				else:
+					self.putx(DATA_BIT_ANN[van_rx])
+			self.bit_acc = ((self.bit_acc << 1) | van_rx) & 0xFFFF
+			if self.ss_block is None:
+				self.ss_block = self.samplenum
+
+	# Handlers for the bits after the EOD, by position after the EOD bit.
+	def ack_delimiter_bit(self, van_rx):
+		if self.show_bits:
+			self.putx(ACK_DELIMITER_BIT_ANN[van_rx])
+		if van_rx != 1:
+			self.putx(ACK_DELIMITER_WARN_ANN)
+
+	def ack_slot_bit(self, van_rx):
+		if self.show_bits:
+			self.putx(ACK_SLOT_BIT_ANN[van_rx])
+		(_, es, _) = self.bit_groups[-1]
+		begin = es + self.bw_int
+		end = begin + self.bw_int
+		self.putg(begin, end, ACK_ANN)
+
+	def eof_first_bit(self, van_rx):
+		self.eof_bit(van_rx)
+		self.ss_block = self.samplenum
+
+	def eof_bit(self, van_rx):
+		if self.show_bits:
+			self.putx(EOF_BIT_ANN[van_rx])
 
+	def eof_last_bit(self, van_rx):
+		self.eof_bit(van_rx)
+		self.putb(EOF_ANN)
+		if van_rx != 1:
+			self.putb(EOF_WARN_ANN)
+
+	tail_fields = (ack_delimiter_bit, ack_slot_bit, eof_first_bit, eof_bit, eof_last_bit)
+
+	# Handle a bit after the EOD (ACK and EOF). Returns True once the
+	# frame is complete.
+	def handle_tail_bit(self, van_rx, bitnum):
+		offset = bitnum - self.tail_start
+		self.tail_fields[offset](self, van_rx)
+		return offset == len(self.tail_fields) - 1
+
+	# Returns True once the frame (including EOF) is complete.
 	def handle_bit(self, van_rx):
-		self.rawbits.append(van_rx)
-		bitnum = len(self.rawbits) -1
+		done = False
 		if self.done:
-
-			tail_bits = len(self.bit_groups) *5 
-			if bitnum == tail_bits:
-				self.putx([20, ['ACK delimiter', 'Delimiter', str(van_rx)]])
-				if van_rx != 1:
-					self.putx([23, ['ACK delimiter must be a recessive bit']])
-			elif bitnum == tail_bits + 1:
-				self.putx([21, ['ACK slot:' + str(van_rx), 'ACK:'+str(van_rx), str(van_rx)]])
-				(_,es,_) = self.bit_groups[-1]
-				begin = es + int(self.bit_width)
-				end = begin + int(self.bit_width)
-				self.putg(begin,end,[9, ['ACK']])
-			elif bitnum == tail_bits + 2:
-				self.putx([22, [str(van_rx)]])
-				self.ss_block = self.samplenum
-			elif bitnum == tail_bits + 3:
-				self.putx([22, [str(van_rx)]])
-			elif bitnum == tail_bits + 4:
-				self.putx([22, [str(van_rx)]])
-				self.putg(self.ss_block, self.samplenum,[10, ['EOF']])
-				if van_rx != 1:
-					self.putg(self.ss_block, self.samplenum,[23, ['End of frame (EOF) must be a recessive bit']])						
-				self.reset_variables()
-				return True			
+			done = self.handle_tail_bit(van_rx, self.curbit)
 		else:
-			stuff_bit = bitnum % 5 == 4
-			if stuff_bit:
-				bits = self.bits[-4:]
-				self.bit_groups.append((self.ss_block, self.samplenum, bits))
-				raw = int(''.join(str(d) for d in self.rawbits[-5:]), 2)
-				if raw & 3 == 0:
-					self.putx([19, ['EOD bit: ' + str(van_rx), 'EOD:'+str(van_rx),str(van_rx)]])
-					self.decode_frame()
-				else:
-					if van_rx:
-						self.putx([12, ['Stuff: 1','S(1)','1']])
-					else:
-						self.putx([12, ['Stuff: 0','S(0)','0']])
-			else:
-				if bitnum < 10:
-					self.putx([13, [str(van_rx)]])
-				elif bitnum < 25:
-					self.putx([14, [str(van_rx)]])
-				elif bitnum == 25:
-					self.putx([15, ['EXT: '+str(van_rx),'EXT'+str(van_rx),str(van_rx)]])
-				elif bitnum == 26:
-					self.putx([16, ['RAK: '+str(van_rx),'RAK'+str(van_rx),str(van_rx)]])
-				elif bitnum == 27:
-					self.putx([17, ['R/W: '+str(van_rx),'RW'+str(van_rx),str(van_rx)]])
-				elif bitnum == 28:
-					self.putx([18, ['RTR: '+str(van_rx),'RTR'+str(van_rx),str(van_rx)]])
-				elif bitnum >= 29:
-					self.putx([11, [str(van_rx)]])
-				self.bits.append(van_rx)			
-				if bitnum % 5 == 0:
-					self.ss_block = self.samplenum
+			self.handle_frame_bit(van_rx, self.curbit)
 		self.curbit += 1
+		if done:
+			self.flush()
+			self.reset_variables()
+		return done
 
 	def decode(self):
 		if not self.samplerate:
 			raise SamplerateError('Cannot decode without samplerate.')
 
-		while True:
-			# State machine.
-			if self.state == 'IDLE':
+		# libsigrokdecode parses the conditions on every wait() call, so
+		# the list is built once and only the skip count is updated.
+		conds = [{'skip': 0}, {0: 'f'}]
+		skip = conds[0]
+		sof_cond = {0: 'l'}
+
+		# Bind the per-bit methods to locals once, instead of looking
+		# them up on self for every sampled bit.
+		wait = self.wait
+		dom_edge_seen = self.dom_edge_seen
+		handle_bit = self.handle_bit
+		bit_sampled = self.bit_sampled
+		bw_q16 = self.bw_q16
+
+		# Newer libsigrokdecode versions raise EOFError from wait() at the
+		# end of the input. Pass on whatever is still queued, so a capture
+		# ending in the middle of a frame still shows its start.
+		try:
+			while True:
 				# Wait for a dominant state (logic 0) on the bus.
-				(van_rx,) = self.wait({0: 'l'})
-				self.dom_edge_seen(force = True)
-				self.state = 'GET_BITS'
-			elif self.state == 'GET_BITS':
-				# Wait until we're in the correct bit/sampling position.
-				pos = self.get_sample_point(self.curbit)
-				(van_rx,) = self.wait([{'skip': pos - self.samplenum}, {0: 'f'}])
-				if self.matched[1]:
-					self.dom_edge_seen()
-				if self.matched[0]:
-					self.handle_bit(van_rx)
-					self.bit_sampled()
+				wait(sof_cond)
+				dom_edge_seen(force = True)
+
+				# Sample all bits of the frame in one tight loop, without
+				# going through the IDLE/GET_BITS dispatch for every bit.
+				# handle_bit() returns True once the EOF has been seen.
+				while True:
+					# Wait until we're in the correct bit/sampling position,
+					# or until a dominant edge allows resynchronisation.
+					pos = (self.sample_base + bw_q16 * self.curbit) >> 16
+					skip['skip'] = pos - self.samplenum
+					(van_rx,) = wait(conds)
+					(at_sample_point, at_edge) = self.matched
+					if at_edge:
+						dom_edge_seen()
+					if at_sample_point:
+						done = handle_bit(van_rx)
+						bit_sampled()
+						if done:
+							break
+		except EOFError:
+			self.flush()
+			raise